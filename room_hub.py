@@ -0,0 +1,231 @@
+# room_hub.py
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Deque, Dict, List, Tuple
+
+from fastapi import WebSocket
+
+MAX_HISTORY = 5000
+OUTBOX_SIZE = 256
+# 一筆畫每秒會送出幾十個 draw，broadcaster 醒來後先等 BATCH_INTERVAL 秒，
+# 再把佇列裡累積的 draw 合併成 batch 一次送出
+BATCH_INTERVAL = 0.015
+
+# (發送者, 編碼好的 JSON bytes, 是否為 draw, publish 當下房間裡的連線)
+QueueItem = Tuple[WebSocket, bytes, bool, Tuple[WebSocket, ...]]
+
+
+def batch_frame(frames: List[bytes]) -> bytes:
+    # 每個 frame 已經是 JSON bytes，直接串接即可，不用再 dumps；前端會依序展開 batch
+    if len(frames) == 1:
+        return frames[0]
+    return b'{"type":"batch","items":[' + b",".join(frames) + b"]}"
+
+
+class Outbox:
+    """
+    單一連線的送出佇列，由該連線自己的 writer task 消化。
+    滿了就丟掉最舊的 draw，clear / topic 等控制訊息一律保留；
+    如果塞滿的全是控制訊息，代表這條連線跟不上，標記 overflowed 交給 writer 斷線。
+    """
+
+    __slots__ = ("maxsize", "frames", "ready", "overflowed")
+
+    def __init__(self, maxsize: int = OUTBOX_SIZE):
+        self.maxsize = maxsize
+        self.frames: Deque[Tuple[bytes, bool]] = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def put(self, data: bytes, droppable: bool = False):
+        if self.overflowed:
+            return
+        if len(self.frames) >= self.maxsize:
+            for i, (_, can_drop) in enumerate(self.frames):
+                if can_drop:
+                    del self.frames[i]
+                    break
+            else:
+                self.overflowed = True
+                self.frames.clear()
+                self.ready.set()
+                return
+        self.frames.append((data, droppable))
+        self.ready.set()
+
+    async def get_all(self) -> List[bytes]:
+        """
+        等到有資料（或 overflowed）後一次取出目前排隊中的所有 frame
+        """
+        while not self.frames and not self.overflowed:
+            self.ready.clear()
+            await self.ready.wait()
+        frames = [data for data, _ in self.frames]
+        self.frames.clear()
+        return frames
+
+
+@dataclass(slots=True)
+class Connection:
+    """
+    單一連線的狀態；連線數多時 slots 比 dict 省記憶體
+    """
+    room_id: str
+    outbox: Outbox = field(default_factory=Outbox)
+    # 上次 generateTheme 的 loop.time()，用來限制頻率
+    last_theme: float = float("-inf")
+    # 上一個 draw frame，用來略過連續重複的點
+    last_draw: bytes = b""
+
+
+class RoomHub:
+    """
+    管理所有房間的連線、主題、歷史與廣播。
+
+    收訊迴圈只呼叫 publish() 把訊息丟進房間佇列，由每個房間唯一的
+    broadcaster task 合併 draw 後分送到各連線的 Outbox。
+    """
+
+    def __init__(self, new_topic: Callable[[], str]):
+        self.new_topic = new_topic
+        # 每個房間的連線是不可變 tuple：加入/離開時重建，廣播時直接拿參考迭代
+        self.rooms: Dict[str, Tuple[WebSocket, ...]] = {}
+        self.topics: Dict[str, str] = {}
+        # 歷史存的是編碼好的 JSON bytes，重播時直接送出；
+        # deque(maxlen) 滿了會自動丟掉最舊的，append 是 O(1)
+        self.history: Dict[str, Deque[bytes]] = {}
+        self.connections: Dict[WebSocket, Connection] = {}
+        self.queues: Dict[str, "asyncio.Queue[QueueItem]"] = {}
+        self.broadcasters: Dict[str, asyncio.Task] = {}
+
+    # ---------------- 連線 ----------------
+    # 下面這些狀態更新中間都沒有 await，在單執行緒的 event loop 上本來就不會被打斷，
+    # 所以不需要鎖
+    def connect(self, websocket: WebSocket, room_id: str) -> List[bytes]:
+        """
+        加入房間，回傳加入當下的歷史快照；之後的廣播會先排進 outbox
+        """
+        self.rooms[room_id] = self.rooms.get(room_id, ()) + (websocket,)
+        self.connections[websocket] = Connection(room_id)
+        self.topics.setdefault(room_id, self.new_topic())
+        history = list(self.history.setdefault(room_id, deque(maxlen=MAX_HISTORY)))
+        if room_id not in self.queues:
+            queue = self.queues[room_id] = asyncio.Queue()
+            self.broadcasters[room_id] = asyncio.create_task(
+                self._broadcaster(queue)
+            )
+        return history
+
+    def disconnect(self, websocket: WebSocket):
+        conn = self.connections.pop(websocket, None)
+        if conn is None:
+            return
+        room_id = conn.room_id
+        self._remove(room_id, websocket)
+        if not self.rooms.get(room_id):
+            self.rooms.pop(room_id, None)
+            self.topics.pop(room_id, None)
+            self.history.pop(room_id, None)
+            self.queues.pop(room_id, None)
+            task = self.broadcasters.pop(room_id, None)
+            if task is not None:
+                task.cancel()
+
+    async def write_outbox(self, websocket: WebSocket):
+        """
+        該連線的 writer task：必須在主題與歷史重播送完後才啟動，
+        同一條連線不會有兩個地方同時在送。
+        每次醒來把排隊中的 frame 全部合併成一個 frame 送出，減少小封包數量。
+        """
+        conn = self.connections[websocket]
+        outbox = conn.outbox
+        try:
+            while True:
+                frames = await outbox.get_all()
+                if outbox.overflowed:
+                    # 跟不上的連線直接斷開，不讓它無限制佔用記憶體
+                    await websocket.close(code=1013)
+                    break
+                await websocket.send_bytes(batch_frame(frames))
+        except Exception:
+            pass
+        # 只退出廣播名單；收訊迴圈可能還在跑，Connection 留到 disconnect() 再清
+        self._remove(conn.room_id, websocket)
+
+    def _remove(self, room_id: str, websocket: WebSocket):
+        if room_id in self.rooms:
+            self.rooms[room_id] = tuple(ws for ws in self.rooms[room_id] if ws is not websocket)
+
+    async def shutdown(self):
+        """
+        server 關閉時：停掉所有房間的 broadcaster 並關閉所有連線
+        """
+        for task in self.broadcasters.values():
+            task.cancel()
+        await asyncio.gather(
+            *(ws.close(code=1001) for ws in list(self.connections)),
+            return_exceptions=True
+        )
+        self.broadcasters.clear()
+        self.queues.clear()
+
+    # ---------------- 歷史 ----------------
+    def record(self, room_id: str, data: bytes):
+        # writer 先結束的連線已不在房間裡，房間可能已經被拆掉
+        history = self.history.get(room_id)
+        if history is not None:
+            history.append(data)
+
+    # ---------------- 廣播 ----------------
+    def publish(self, room_id: str, data: bytes, exclude: WebSocket = None, is_draw: bool = False):
+        # 房間裡沒有其他人（剛開房、只有自己在畫）就不用排進佇列；
+        # 之後加入的人會從歷史重播拿到
+        sockets = self.rooms.get(room_id)
+        if not sockets or (len(sockets) == 1 and sockets[0] is exclude):
+            return
+        queue = self.queues.get(room_id)
+        if queue is not None:
+            # 收件人在 publish 當下就決定：這之後才加入的人，歷史快照裡已經有這筆，
+            # 若改在 broadcaster 醒來時才看房間名單，同一筆會再送一次
+            queue.put_nowait((exclude, data, is_draw, sockets))
+
+    def broadcast(self, recipients: Tuple[WebSocket, ...], data: bytes, exclude: WebSocket = None, droppable: bool = False):
+        # data 已是編碼好的 JSON bytes，所有連線共用同一份；
+        # 只放進各連線的佇列，慢的連線不會卡住其他人
+        for ws in recipients:
+            if ws is exclude:
+                continue
+            # publish 之後才離開的連線就跳過
+            conn = self.connections.get(ws)
+            if conn is not None:
+                conn.outbox.put(data, droppable)
+
+    async def _broadcaster(self, queue: "asyncio.Queue[QueueItem]"):
+        while True:
+            item = await queue.get()
+            if item[2]:
+                await asyncio.sleep(BATCH_INTERVAL)
+
+            items = [item]
+            while not queue.empty():
+                items.append(queue.get_nowait())
+            self._fan_out(items)
+
+    def _fan_out(self, items: List[QueueItem]):
+        # draw 依 (發送者, 收件人) 分組；中途有人加入時，同一人的 draw 會分成前後兩組，
+        # 舊成員依序收到兩組，新成員只收到加入之後的那組
+        draws: Dict[Tuple[WebSocket, Tuple[WebSocket, ...]], List[bytes]] = {}
+        for sender_ws, data, is_draw, recipients in items:
+            if is_draw:
+                draws.setdefault((sender_ws, recipients), []).append(data)
+                continue
+            # 非 draw 訊息前先把累積的 draw 送出，保持順序
+            self._flush_draws(draws)
+            draws = {}
+            self.broadcast(recipients, data, exclude=sender_ws)
+        self._flush_draws(draws)
+
+    def _flush_draws(self, draws: Dict[Tuple[WebSocket, Tuple[WebSocket, ...]], List[bytes]]):
+        for (sender_ws, recipients), frames in draws.items():
+            self.broadcast(recipients, batch_frame(frames), exclude=sender_ws, droppable=True)
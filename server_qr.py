@@ -1,26 +1,47 @@
 # server_qr.py
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse
+from starlette.datastructures import Headers
 import uvicorn
 import os
+import sys
+import base64
+import time
 import logging
-import json
+import orjson
 import asyncio
-import qrcode
+import segno
 import io
 import random
-from typing import Dict, Set, List
+import hashlib
+import mimetypes
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Dict, Tuple
 UPLOAD_DIR = r"C:\PROJECT\my_wall_app\www\uploads\albums\draw"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-from openai import OpenAI
+from openai import AsyncOpenAI
+from PIL import Image
 from fastapi import Body
+from room_hub import Connection, RoomHub, batch_frame
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("server_qr")
 
-app = FastAPI()
+# --------------------
+# 生命週期：啟動時建立 RoomHub，關閉時收掉所有連線與背景 task
+# --------------------
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    hub = RoomHub(get_random_topic)
+    app.state.hub = hub
+    yield
+    await hub.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # --------------------
 # CORS
@@ -36,7 +57,8 @@ app.add_middleware(
 # --------------------
 # OpenAI
 # --------------------
-client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+# 用 async client，等待 OpenAI 回應時不會卡住其他房間的 WebSocket
+client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
 
 # --------------------
 # Render / Static
@@ -45,117 +67,198 @@ RENDER_BASE_URL = os.environ.get("RENDER_EXTERNAL_URL")
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
+# 首頁路徑啟動時算一次，不用每個請求都 join + 檢查
+INDEX_FILE = os.path.join(STATIC_DIR, "index.html")
+INDEX_EXISTS = os.path.isfile(INDEX_FILE)
+
+# 小檔案（html / js / 小圖）啟動時就讀進記憶體，之後每次請求不用再 stat + open
+STATIC_CACHE_MAX_BYTES = 64 * 1024
+
+class CachedStaticFiles(StaticFiles):
+    """
+    StaticFiles 加上記憶體快取；大檔案或快取裡沒有的路徑照原本方式處理。
+    檔案只在啟動時讀一次，改了靜態檔需要重啟 server。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache: Dict[str, Tuple[bytes, str, str]] = {}
+        for root, _, files in os.walk(self.directory):
+            for filename in files:
+                full_path = os.path.join(root, filename)
+                if os.path.getsize(full_path) > STATIC_CACHE_MAX_BYTES:
+                    continue
+                with open(full_path, "rb") as f:
+                    content = f.read()
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                etag = '"' + hashlib.md5(content).hexdigest() + '"'
+                self.cache[os.path.relpath(full_path, self.directory)] = (content, media_type, etag)
+
+    async def get_response(self, path: str, scope) -> Response:
+        cached = self.cache.get(path)
+        if cached is None or scope["method"] != "GET":
+            return await super().get_response(path, scope)
+
+        content, media_type, etag = cached
+        if Headers(scope=scope).get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(content, media_type=media_type, headers={"ETag": etag})
 
 if os.path.exists(STATIC_DIR):
-    app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+    app.mount("/static", CachedStaticFiles(directory=STATIC_DIR), name="static")
 
 # --------------------
 # 主題
 # --------------------
+TOPICS = (
+    "太空冒險", "海底世界", "未來城市", "森林探險",
+    "恐龍世界", "機器人王國", "動物村派對", "海盜寶藏",
+    "異世界冒險"
+)
+
 def get_random_topic():
-    return random.choice([
-        "太空冒險", "海底世界", "未來城市", "森林探險",
-        "恐龍世界", "機器人王國", "動物村派對", "海盜寶藏",
-        "異世界冒險"
-    ])
+    return random.choice(TOPICS)
 
-# --------------------
-# 房間管理
-# --------------------
-rooms: Dict[str, Set[WebSocket]] = {}
-room_topics: Dict[str, str] = {}
-room_history: Dict[str, List[dict]] = {}
-rooms_lock = asyncio.Lock()
-MAX_HISTORY = 5000
-
-async def broadcast(room_id: str, message: str, sender_ws: WebSocket = None):
-    async with rooms_lock:
-        sockets = list(rooms.get(room_id, []))
-
-    dead = []
-    for ws in sockets:
-        if ws is sender_ws:
-            continue
-        try:
-            await ws.send_text(message)
-        except Exception:
-            dead.append(ws)
+def topic_frame(topic: str) -> bytes:
+    # 外框固定，只需要編碼主題字串本身
+    return b'{"type":"topic","value":' + orjson.dumps(topic) + b"}"
 
-    if dead:
-        async with rooms_lock:
-            for ws in dead:
-                rooms[room_id].discard(ws)
+# 主題只有固定幾個，frame 啟動時就編好；新連線與換主題時直接查表
+TOPIC_FRAMES = {topic: topic_frame(topic) for topic in TOPICS}
 
 # --------------------
 # WebSocket
 # --------------------
+# 換主題會廣播給整個房間，同一條連線每秒最多一次，避免被洗版放大流量。
+# clear 不限制：前端按下去就先清掉自己的畫布，server 丟掉的話房間會不同步
+CONTROL_COOLDOWN = 1.0
+# 重播歷史時每個 batch 包含的訊息數
+REPLAY_CHUNK = 256
+
+def parse_frame(raw: str):
+    """
+    解析成 dict；不是合法的 JSON 物件就回傳 None。
+    歷史與 batch 是直接把 frame bytes 串起來的，一個壞掉的 frame 會讓整個 batch
+    JSON.parse 失敗，所以進歷史或廣播前一定要先檢查
+    """
+    try:
+        payload = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str):
     await websocket.accept()
 
-    async with rooms_lock:
-        rooms.setdefault(room_id, set()).add(websocket)
-        room_topics.setdefault(room_id, get_random_topic())
-        room_history.setdefault(room_id, [])
-
-    # 傳主題
-    await websocket.send_text(json.dumps({
-        "type": "topic",
-        "value": room_topics[room_id]
-    }))
-
-    # 重播歷史
-    async with rooms_lock:
-        history = list(room_history[room_id])
-    for h in history:
-        await websocket.send_text(json.dumps(h))
+    hub: RoomHub = websocket.app.state.hub
+    history = hub.connect(websocket, room_id)
 
     try:
-        while True:
-            raw = await websocket.receive_text()
-            payload = json.loads(raw)
-            ptype = payload.get("type")
-
-            # ---------------- AI 故事 ----------------
-            if ptype == "aiStory":
-                logger.info("🧠 AI Story requested")
-                story = await generate_ai_story(payload.get("image"))
-
-                msg = {"type": "story", "story": story}
-                await broadcast(room_id, json.dumps(msg))
-                continue
-
-            # ---------------- 主題 ----------------
-            if ptype == "generateTheme":
-                topic = get_random_topic()
-                room_topics[room_id] = topic
-                msg = {"type": "topic", "value": topic}
-                room_history[room_id].append(msg)
-                await broadcast(room_id, json.dumps(msg))
-                continue
-
-            # ---------------- 畫畫 / clear ----------------
-            room_history[room_id].append(payload)
-            if len(room_history[room_id]) > MAX_HISTORY:
-                room_history[room_id] = room_history[room_id][-MAX_HISTORY:]
-
-            await broadcast(room_id, json.dumps(payload), sender_ws=websocket)
-
-    except WebSocketDisconnect:
+        # 傳主題
+        await websocket.send_bytes(TOPIC_FRAMES[hub.topics[room_id]])
+
+        # 重播歷史：歷史本來就是編碼好的 frame，直接串成 batch 分段送出
+        for i in range(0, len(history), REPLAY_CHUNK):
+            await websocket.send_bytes(batch_frame(history[i:i + REPLAY_CHUNK]))
+
+        # 重播完才開始消化 outbox，同一條連線不會有兩個地方同時在送。
+        # 收訊迴圈結束（斷線或例外）時 TaskGroup 會一併取消 writer，不會留下孤兒 task；
+        # writer 先結束（送失敗或 outbox 爆掉被關閉）代表連線已經不能用，收訊迴圈也跟著停
+        async with asyncio.TaskGroup() as tg:
+            receiver = tg.create_task(receive_loop(hub, websocket))
+            await hub.write_outbox(websocket)
+            receiver.cancel()
+
+    except* WebSocketDisconnect:
         logger.info(f"🔴 disconnect {room_id}")
     finally:
-        async with rooms_lock:
-            rooms[room_id].discard(websocket)
-            if not rooms[room_id]:
-                rooms.pop(room_id, None)
-                room_topics.pop(room_id, None)
-                room_history.pop(room_id, None)
+        hub.disconnect(websocket)
+
+# ---------------- 訊息處理 ----------------
+# 每個 handler 收到 (hub, websocket, 這條連線的 Connection, 解析後的 payload, 原始 bytes)；
+# conn 在收訊迴圈開始時就拿好，writer 先結束時也不必再去 hub 查
+
+async def handle_ai_story(hub: RoomHub, websocket: WebSocket, conn: Connection, payload: dict, data: bytes):
+    logger.info("🧠 AI Story requested")
+    story = await generate_ai_story(payload.get("image"))
+
+    msg = {"type": "story", "story": story}
+    hub.publish(conn.room_id, orjson.dumps(msg))
+
+async def handle_generate_theme(hub: RoomHub, websocket: WebSocket, conn: Connection, payload: dict, data: bytes):
+    now = asyncio.get_running_loop().time()
+    if now - conn.last_theme < CONTROL_COOLDOWN:
+        return
+    conn.last_theme = now
+
+    topic = get_random_topic()
+    hub.topics[conn.room_id] = topic
+    msg = TOPIC_FRAMES[topic]
+    hub.record(conn.room_id, msg)
+    hub.publish(conn.room_id, msg)
+
+async def handle_draw(hub: RoomHub, websocket: WebSocket, conn: Connection, payload: dict, data: bytes):
+    # pointermove 停在同一點時會送出一模一樣的 draw（同筆畫、同座標），
+    # 畫出來是長度 0 的線段，不必進歷史也不必廣播
+    if data == conn.last_draw:
+        return
+    conn.last_draw = data
+    hub.record(conn.room_id, data)
+    hub.publish(conn.room_id, data, exclude=websocket, is_draw=True)
+
+async def handle_default(hub: RoomHub, websocket: WebSocket, conn: Connection, payload: dict, data: bytes):
+    hub.record(conn.room_id, data)
+    # 解析過確定是合法 JSON，原始 bytes 直接轉發，不必再 dumps 一次
+    hub.publish(conn.room_id, data, exclude=websocket)
+
+HANDLERS = {
+    "aiStory": handle_ai_story,
+    "generateTheme": handle_generate_theme,
+    "draw": handle_draw,
+}
+
+async def receive_loop(hub: RoomHub, websocket: WebSocket):
+    conn = hub.connections[websocket]
+
+    while True:
+        raw = await websocket.receive_text()
+        data = raw.encode("utf-8")
+
+        # 每個 frame 只解析一次：不合法就丟掉，合法的依 type 分派（draw 也一樣）；
+        # 轉發時用的是原始 bytes，不必再 dumps
+        payload = parse_frame(raw)
+        if payload is None:
+            continue
+        handler = HANDLERS.get(payload.get("type"), handle_default)
+        await handler(hub, websocket, conn, payload, data)
 
 # --------------------
 # AI Story 核心
 # --------------------
-async def generate_ai_story(base64_image: str):
-    image = base64_image.replace("data:image/png;base64,", "")
+# 畫布是 1920x1080，送給模型前縮到最長邊 AI_IMAGE_MAX，上傳量少很多
+AI_IMAGE_MAX = 1024
+
+def downscale_image_url(image_url: str) -> str:
+    """
+    把 data URL 裡的圖片縮到最長邊 AI_IMAGE_MAX 以內，重新編成 PNG data URL；
+    本來就夠小就原樣回傳。解碼與壓縮很吃 CPU，要丟到 executor 裡跑
+    """
+    b64 = image_url.partition(",")[2]
+    img = Image.open(io.BytesIO(base64.b64decode(b64)))
+    if max(img.size) <= AI_IMAGE_MAX:
+        return image_url
+    img.thumbnail((AI_IMAGE_MAX, AI_IMAGE_MAX))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+
+async def request_ai_story(base64_image: str) -> dict:
+    # 前端 canvas.toDataURL() 已經是 data URL，直接沿用，不必拆開再組回去
+    if base64_image.startswith("data:"):
+        image_url = base64_image
+    else:
+        image_url = f"data:image/png;base64,{base64_image}"
 
     prompt = """
 你是一個專業的圖像觀察員與教育型故事創作者。
@@ -217,29 +320,62 @@ async def generate_ai_story(base64_image: str):
   "moral": "..."
 }
 """
-    try:
-        res = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[{
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": prompt},
-                    {"type": "image_url",
-                     "image_url": {"url": f"data:image/png;base64,{image}"}}
-                ]
-            }],
-            temperature=0.4,
-            max_tokens=800
-        )
-
-        content = res.choices[0].message.content.strip()
-
-        # 有時模型會包 ```json
-        if content.startswith("```"):
-            content = content.split("```")[1]
-
-        return json.loads(content)
+    loop = asyncio.get_running_loop()
+    image_url = await loop.run_in_executor(None, downscale_image_url, image_url)
+
+    res = await client.chat.completions.create(
+        model="gpt-4.1-mini",
+        messages=[{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt},
+                {"type": "image_url",
+                 "image_url": {"url": image_url}}
+            ]
+        }],
+        temperature=0.4,
+        max_tokens=800
+    )
+
+    content = res.choices[0].message.content.strip()
+
+    # 有時模型會包 ```json
+    if content.startswith("```"):
+        content = content.split("```")[1]
+
+    return orjson.loads(content)
+
+
+# 同一張畫布（重複按按鈕、同房間多人同時要故事）只打一次 OpenAI：
+# 成功的結果以圖片的 sha256 做 LRU 快取，進行中的請求共用同一個 task
+STORY_CACHE_SIZE = 128
+_story_cache: "OrderedDict[str, dict]" = OrderedDict()
+_story_pending: Dict[str, asyncio.Task] = {}
+
+def _story_done(key: str, task: asyncio.Task):
+    _story_pending.pop(key, None)
+    # 失敗不快取，下次再試
+    if task.cancelled() or task.exception() is not None:
+        return
+    _story_cache[key] = task.result()
+    if len(_story_cache) > STORY_CACHE_SIZE:
+        _story_cache.popitem(last=False)
+
+async def generate_ai_story(base64_image: str):
+    key = hashlib.sha256(base64_image.encode("utf-8")).hexdigest()
+    story = _story_cache.get(key)
+    if story is not None:
+        _story_cache.move_to_end(key)
+        return story
+
+    task = _story_pending.get(key)
+    if task is None:
+        task = _story_pending[key] = asyncio.create_task(request_ai_story(base64_image))
+        task.add_done_callback(lambda t: _story_done(key, t))
 
+    try:
+        # shield：某個等待者斷線被取消時，不影響其他人共用的請求
+        return await asyncio.shield(task)
     except Exception as e:
         logger.error(f"AI 生成失敗: {e}")
         return {
@@ -249,10 +385,9 @@ async def generate_ai_story(base64_image: str):
             "scenes": []
         }
 
-from fastapi import Body
 
 @app.post("/ai/story")
-async def ai_story(data: dict = Body(...)):
+async def ai_story(request: Request, data: dict = Body(...)):
     """
     接收前端 canvas base64，回傳文字故事
     """
@@ -267,8 +402,6 @@ async def ai_story(data: dict = Body(...)):
     print("UPLOAD_DIR =", UPLOAD_DIR)
     print("ABS PATH =", os.path.abspath(UPLOAD_DIR))
     print("CURRENT DIR =", os.getcwd())
-    import base64
-    import time
 
     # === 存 canvas 圖片 ===
     try:
@@ -305,7 +438,7 @@ async def ai_story(data: dict = Body(...)):
     }
 
     # ✅ 關鍵：WebSocket 廣播
-    await broadcast(room, json.dumps(msg))
+    request.app.state.hub.publish(room, orjson.dumps(msg))
 
     return {
         "title": story_json.get("title", "AI 故事"),
@@ -316,23 +449,46 @@ async def ai_story(data: dict = Body(...)):
 # --------------------
 @app.get("/", include_in_schema=False)
 async def index():
-    return FileResponse(os.path.join(STATIC_DIR, "index.html"))
+    if not INDEX_EXISTS:
+        return JSONResponse({"error": "index.html not found"}, status_code=404)
+    return FileResponse(INDEX_FILE)
+
+QR_CACHE_CONTROL = "public, max-age=86400"
+
+# 同一個網址產生的 QR 一定相同，直接快取 PNG bytes
+@lru_cache(maxsize=512)
+def render_qr_png(text: str) -> bytes:
+    # segno 直接從 bit matrix 寫 PNG，不需要 Pillow
+    qr = segno.make(text, error="m")
+    buf = io.BytesIO()
+    qr.save(buf, kind="png", scale=10, border=4)
+    return buf.getvalue()
 
 @app.get("/qr-room/{room}")
-def qr_room(room: str, name: str = "User"):
+def qr_room(request: Request, room: str, name: str = "User"):
     base = RENDER_BASE_URL or "http://127.0.0.1:8000"
     url = f"{base}/static/index.html?room={room}&name={name}"
-    img = qrcode.make(url)
-    buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="image/png")
+    etag = '"' + hashlib.sha1(url.encode("utf-8")).hexdigest() + '"'
+    headers = {"Cache-Control": QR_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    png = render_qr_png(url)
+    return Response(content=png, media_type="image/png", headers=headers)
 
 # --------------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
-
-
-
-
+    # uvloop 不支援 Windows，本機開發時退回內建 asyncio
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=port,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # draw / batch frame 裡重複的 key 很多，permessage-deflate 壓縮率高；
+        # 手機連 Render 時頻寬才是瓶頸，多花一點 CPU 換流量划算
+        ws_per_message_deflate=True,
+        # uvicorn 每條連線開關都會打 info log，連線多時很吵也浪費時間；app 自己的 log 不受影響
+        log_level="warning",
+    )